@@ -2,24 +2,40 @@
 """
 OG card generator — with round avatar + bigger GitHub mark + bottom bar.
 Saves: social_preview.png
+
+Importable too: render_card() returns an image, render_many() writes a batch
+of cards over a process pool so each worker reuses its font/mask/canvas caches.
+Batch CLI: generate_og.py --manifest cards.json --outdir out/
 """
 
 import os
+import glob
+import shutil
+import hashlib
+import subprocess
+import json
+import inspect
 import argparse
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import PIL
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
 
 FONT_REGULAR = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
 FONT_BOLD = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
 
+CARD_SIZE = (1280, 640)
+
+@lru_cache(maxsize=32)
 def load_font(path, size):
     try:
         return ImageFont.truetype(path, size)
     except Exception:
         return ImageFont.load_default()
 
-def measure(draw, text, font):
+def measure(text, font):
     try:
-        b = draw.textbbox((0,0), text, font=font)
+        b = font.getbbox(text)
         return b[2]-b[0], b[3]-b[1]
     except Exception:
         try:
@@ -27,43 +43,115 @@ def measure(draw, text, font):
         except Exception:
             return (len(text)*6, 20)
 
-def wrap_text(text, font, max_w, draw):
-    words = text.split()
+def text_width(text, font):
+    # getlength only computes advance width, far cheaper than a full getbbox
+    try:
+        return font.getlength(text)
+    except AttributeError:
+        return measure(text, font)[0]
+
+def line_height(font):
+    # ascent + descent is constant per font; no per-line layout needed
+    try:
+        return sum(font.getmetrics())
+    except AttributeError:
+        return measure("Ag", font)[1]
+
+def wrap_text(text, font, max_w):
+    # Advance widths are additive, so keep a running line width and measure
+    # only the incoming " word" instead of re-measuring the whole line.
     lines = []
-    cur = ""
-    for w in words:
-        test = cur + (" " if cur else "") + w
-        w_px, _ = measure(draw, test, font)
-        if w_px <= max_w:
-            cur = test
+    cur_parts = []
+    cur_w = 0
+    for w in text.split():
+        inc = text_width((" " if cur_parts else "") + w, font)
+        if cur_parts and cur_w + inc > max_w:
+            lines.append(" ".join(cur_parts))
+            cur_parts = [w]
+            cur_w = text_width(w, font)
         else:
-            if cur:
-                lines.append(cur)
-            cur = w
-    if cur:
-        lines.append(cur)
+            cur_parts.append(w)
+            cur_w += inc
+    if cur_parts:
+        lines.append(" ".join(cur_parts))
     return lines
 
-def draw_stats(draw, x, y, font, color):
+def draw_stats(draw, x, y, font, color, spacing=64):
     items = [("Contributors", "1"), ("Issues", "0"), ("Stars", "0"), ("Forks", "0")]
-    spacing = 64
-    for label, count in items:
-        text = f"{count} {label}"
+    texts = [f"{count} {label}" for label, count in items]
+    widths = [text_width(t, font) for t in texts]
+    for text, w in zip(texts, widths):
         draw.text((x, y), text, font=font, fill=color)
-        w, _ = measure(draw, text, font)
         x += w + spacing
 
-def crop_circle(im):
-    """Returns a perfectly circular cropped version of the image."""
+def fit(im, max_side):
+    """Downscale im to fit in a max_side square, keeping aspect ratio."""
     w, h = im.size
-    size = min(w, h)
-    im = im.crop(((w - size) // 2, (h - size) // 2, (w + size) // 2, (h + size) // 2))  # square
-    mask = Image.new("L", (size, size), 0)
-    draw = ImageDraw.Draw(mask)
-    draw.ellipse((0,0,size,size), fill=255)
-    output = Image.new("RGBA", (size, size), (0,0,0,0))
-    output.paste(im, (0,0), mask)
-    return output
+    s = min(max_side / w, max_side / h, 1.0)
+    if s >= 1:
+        return im
+    return im.resize((max(1, int(w*s)), max(1, int(h*s))), Image.LANCZOS)
+
+@lru_cache(maxsize=16)
+def rounded_mask(w, h, radius):
+    """Anti-aliased rounded-rect mask, drawn at 4x and downsampled once per shape."""
+    big = Image.new("L", (w*4, h*4), 0)
+    ImageDraw.Draw(big).rounded_rectangle((0,0,w*4,h*4), radius=radius*4, fill=255)
+    return big.resize((w,h), Image.LANCZOS)
+
+def crop_circle(im, size=None):
+    """Returns a perfectly circular cropped version of the image, optionally resized."""
+    w, h = im.size
+    side = min(w, h)
+    im = im.crop(((w - side) // 2, (h - side) // 2, (w + side) // 2, (h + side) // 2))  # square
+    if size:
+        im = im.resize((size,size), Image.LANCZOS)
+    im = im.convert("RGBA")
+    im.putalpha(ImageChops.multiply(im.getchannel("A"), rounded_mask(im.size[0], im.size[1], im.size[0]//2)))
+    return im
+
+def load_avatar(path, size=180):
+    """Circular RGBA avatar, cached on disk next to the source image.
+
+    The cache file name carries a hash of the source's stat, the script's stat
+    and the Pillow version, so a replaced logo (even one with an older mtime)
+    or changed processing code never reuses a stale avatar.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(PIL.__version__.encode())
+    for p in (path, __file__):
+        st = os.stat(p)
+        h.update(f"{st.st_mtime_ns}:{st.st_size}".encode())
+    cache = f"{path}.cache{size}-{h.hexdigest()}.png"
+    try:
+        return Image.open(cache)
+    except OSError:
+        pass
+    im = Image.open(path)
+    if im.format == "JPEG":
+        # let libjpeg scale down during decode (1/2, 1/4, 1/8)
+        im.draft("RGB", (size,size))
+    im = crop_circle(im.convert("RGBA"), size)
+    try:
+        # write-then-rename so parallel workers never read a partial file
+        tmp = f"{cache}.{os.getpid()}.tmp"
+        im.save(tmp, format="PNG", compress_level=1)
+        os.replace(tmp, cache)
+        # drop avatars cached from earlier versions of this source
+        for stale in glob.glob(f"{glob.escape(path)}.cache{size}-*.png"):
+            if stale != cache:
+                os.remove(stale)
+    except OSError as e:
+        print("Avatar cache error:", e)
+    return im
+
+@lru_cache(maxsize=4)
+def blank_card(w, h, bg, bar_h, split, left_color, right_color):
+    """Background plus two-tone bottom bar, filled once; callers copy() it."""
+    card = Image.new("RGB", (w, h), bg)
+    card.paste(left_color, (0, h - bar_h, split, h))
+    card.paste(right_color, (split, h - bar_h, w, h))
+    return card
 
 def draw_github_fallback(draw, gx, gy, size=48):
     """Draw fallback GH icon if github-mark.png missing."""
@@ -71,124 +159,323 @@ def draw_github_fallback(draw, gx, gy, size=48):
     rect = [gx, gy, gx + size, gy + size]
     draw.rounded_rectangle(rect, radius=r, fill=(36, 41, 46))
     f = load_font(FONT_BOLD, size//2)
-    tw, th = measure(draw, "GH", f)
+    tw, th = measure("GH", f)
     tx = gx + (size - tw)//2
     ty = gy + (size - th)//2
     draw.text((tx, ty), "GH", font=f, fill=(255,255,255))
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--output", default="social_preview.png")
-    ap.add_argument("--title", default="username/repo")
-    ap.add_argument("--subtitle", default="A project description.")
-    ap.add_argument("--author", default="")
-    ap.add_argument("--sha", default="")
-    ap.add_argument("--logo", default="assets/brand-logo.png")
-    ap.add_argument("--github-mark", default="assets/github-mark.png")
-    args = ap.parse_args()
+def cache_key(card, output):
+    """Hash of every render input: card fields, Pillow build, stat of assets and fonts."""
+    h = hashlib.blake2b(repr(sorted(card.items())).encode(), digest_size=16)
+    h.update(os.path.splitext(output)[1].lower().encode())
+    h.update(PIL.__version__.encode())
+    for path in (card.get("logo"), card.get("github_mark"), FONT_REGULAR, FONT_BOLD, __file__):
+        try:
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_mtime_ns}:{st.st_size}".encode())
+        except (OSError, TypeError):
+            h.update(f"{path}:missing".encode())
+    return h.hexdigest()
+
+def cache_path(cache_dir, card, output, optimize=False):
+    """Location of the memoized render for `card` written as `output`."""
+    ext = os.path.splitext(output)[1]
+    return os.path.join(cache_dir, cache_key(dict(card, optimize=optimize), output) + ext)
+
+def prune_cache(cache_dir, keep=64, protect=()):
+    """Drop all but the `keep` most recently used cache entries.
+
+    Entries in `protect` (those used by the current run) are never evicted.
+    """
+    protect = {os.path.abspath(p) for p in protect}
+    try:
+        entries = [os.path.join(cache_dir, n) for n in os.listdir(cache_dir)]
+    except OSError:
+        return
+    others = []
+    for path in entries:
+        if os.path.abspath(path) in protect:
+            continue
+        try:
+            others.append((os.path.getmtime(path), path))
+        except OSError:
+            pass
+    others.sort(reverse=True)
+    room = max(0, keep - (len(entries) - len(others)))
+    for _, path in others[room:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def save_image(img, path, optimize=False):
+    """Fast zlib/JPEG settings by default; --optimize trades time for size."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        if optimize:
+            img.save(path, optimize=True)
+        else:
+            img.save(path, compress_level=1)
+    else:
+        img.save(path, quality=95 if optimize else 90, optimize=optimize)
+    if not optimize:
+        return
+    # Archival output: let a dedicated optimizer squeeze it further if present
+    tool = {".png": ["optipng", "-quiet", "-o2"], ".jpg": ["jpegoptim", "-q"], ".jpeg": ["jpegoptim", "-q"]}.get(ext)
+    if tool and shutil.which(tool[0]):
+        try:
+            subprocess.run(tool + [path], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Optimize error:", e)
+
+def render_card(title="username/repo", subtitle="A project description.", author="",
+                sha="", logo="assets/brand-logo.png", github_mark="assets/github-mark.png",
+                draft=False):
+    """Draw one OG card and return it as an RGB image.
+
+    With draft=True the card is laid out at half resolution without the
+    bottom bar; generate() scales it back up for a quick layout preview.
+    """
+    scale = 0.5 if draft else 1
+    def S(v):
+        return max(1, round(v * scale))
 
-    W, H = 1280, 640
+    W, H = S(CARD_SIZE[0]), S(CARD_SIZE[1])
     BG = (255,255,255)
     TEXT = (28,32,36)
     SUB = (98,108,118)
     STATS = (100,110,124)
 
-    img = Image.new("RGB", (W,H), BG)
+    bar_h = S(18)
+
+    # Background and bottom color bar (red | blue) come prefilled
+    img = blank_card(W, H, BG, 0 if draft else bar_h, int(W*0.6), (232,76,61), (44,111,180)).copy()
     draw = ImageDraw.Draw(img)
 
-    left = 100
-    right = W - 260
+    left = S(100)
+    right = W - S(260)
     maxw = right - left
 
-    raw = args.title or "unknown/repo"
+    raw = title or "unknown/repo"
     if "/" in raw:
         owner, repo = raw.split("/", 1)
     else:
         owner, repo = "", raw
 
-    f_owner = load_font(FONT_REGULAR, 28)
-    f_repo = load_font(FONT_BOLD, 64)
-    f_desc = load_font(FONT_REGULAR, 26)
-    f_stats = load_font(FONT_REGULAR, 22)
+    repo_max, repo_min = S(64), S(30)
+    f_owner = load_font(FONT_REGULAR, S(28))
+    f_repo = load_font(FONT_BOLD, repo_max)
+    f_desc = load_font(FONT_REGULAR, S(26))
+    f_stats = load_font(FONT_REGULAR, S(22))
 
     # Owner
-    y = 120
+    y = S(120)
     if owner:
         draw.text((left, y), f"{owner}/", font=f_owner, fill=SUB)
-        _, oh = measure(draw, f"{owner}/", f_owner)
-        y += oh + 10
+        _, oh = measure(f"{owner}/", f_owner)
+        y += oh + S(10)
 
     # Repo (shrink as needed)
-    rw, rh = measure(draw, repo, f_repo)
+    rw = text_width(repo, f_repo)
     if rw > maxw:
-        for s in range(64, 28, -2):
-            f_repo = load_font(FONT_BOLD, s)
-            rw, rh = measure(draw, repo, f_repo)
-            if rw <= maxw:
-                break
+        # advance widths scale linearly with point size: solve for it directly
+        s = max(repo_min, int(repo_max * maxw / rw) & ~1)
+        # hinting makes scaling slightly non-linear; nudge by one step either way
+        while s < repo_max - 2 and text_width(repo, load_font(FONT_BOLD, s + 2)) <= maxw:
+            s += 2
+        while s > repo_min and text_width(repo, load_font(FONT_BOLD, s)) > maxw:
+            s = max(repo_min, s - 2)  # the scaled floor may be odd
+        f_repo = load_font(FONT_BOLD, s)
+    _, rh = measure(repo, f_repo)
     draw.text((left, y), repo, font=f_repo, fill=TEXT)
-    y += rh + 18
+    y += rh + S(18)
 
     # Description
-    lines = wrap_text(args.subtitle, f_desc, maxw, draw)[:3]
+    lines = wrap_text(subtitle, f_desc, maxw)[:3]
+    desc_h = line_height(f_desc) + S(6)
     for line in lines:
         draw.text((left, y), line, font=f_desc, fill=SUB)
-        _, lh = measure(draw, line, f_desc)
-        y += lh + 6
+        y += desc_h
 
     # Stats
-    y += 18
-    draw_stats(draw, left, y, f_stats, STATS)
+    y += S(18)
+    draw_stats(draw, left, y, f_stats, STATS, spacing=S(64))
 
     # Meta bottom-left
     meta = ""
-    if args.author:
-        meta = f"by {args.author}"
-    if args.sha:
-        meta += f" • {args.sha[:7]}"
-    draw.text((left, H-64), meta, font=f_stats, fill=SUB)
+    if author:
+        meta = f"by {author}"
+    if sha:
+        meta += f" • {sha[:7]}"
+    draw.text((left, H-S(64)), meta, font=f_stats, fill=SUB)
 
     # Round avatar (top-right)
-    if os.path.exists(args.logo):
+    if os.path.exists(logo):
         try:
-            avatar = Image.open(args.logo).convert("RGBA")
-            avatar = crop_circle(avatar)
-            avatar = avatar.resize((180,180), Image.LANCZOS)
+            avatar = load_avatar(logo, S(180))
 
             # Optional white border
-            border = ImageOps.expand(avatar, border=6, fill="white")
+            border = ImageOps.expand(avatar, border=S(6), fill="white")
 
             # Position
-            ax = W - 260 + (260 - border.size[0])//2
-            ay = 100
+            ax = W - S(260) + (S(260) - border.size[0])//2
+            ay = S(100)
             img.paste(border, (ax, ay), border)
 
         except Exception as e:
             print("Avatar error:", e)
 
-    # Bottom color bar
-    bar_h = 18
-    draw.rectangle([0, H-bar_h, int(W*0.6), H], fill=(232,76,61))   # red
-    draw.rectangle([int(W*0.6), H-bar_h, W, H], fill=(44,111,180)) # blue
-
     # Bigger GitHub icon
-    gh_size = 48
-    gx = W - 48 - gh_size
-    gy = H - bar_h - gh_size - 12
+    gh_size = S(48)
+    gx = W - S(48) - gh_size
+    gy = H - bar_h - gh_size - S(12)
 
-    if os.path.exists(args.github_mark):
+    if os.path.exists(github_mark):
         try:
-            gh = Image.open(args.github_mark).convert("RGBA")
-            gh.thumbnail((gh_size, gh_size))
+            gh = Image.open(github_mark).convert("RGBA")
+            gh = fit(gh, gh_size)
             img.paste(gh, (gx, gy), gh)
         except:
             draw_github_fallback(draw, gx, gy, size=gh_size)
     else:
         draw_github_fallback(draw, gx, gy, size=gh_size)
 
-    # Save final image
-    img.save(args.output, quality=95)
-    print("Generated", args.output)
+    return img
+
+def generate(output, card, optimize=False, cache_dir=".og_cache", cache_size=64, prune=True):
+    """Render `card` (render_card kwargs) to `output`, reusing an identical earlier render.
+
+    With prune=False the cache is left for the caller to trim (see render_many).
+    """
+    cached = None
+    if cache_dir:
+        cached = cache_path(cache_dir, card, output, optimize)
+        try:
+            shutil.copyfile(cached, output)
+            os.utime(cached)
+            print("Generated", output, "(cached)")
+            return output
+        except OSError:
+            pass  # missing (or pruned meanwhile): render it
+
+    img = render_card(**card)
+    if card.get("draft"):
+        # cheap blocky upscale, layout preview only
+        img = img.resize(CARD_SIZE, Image.NEAREST)
+    save_image(img, output, optimize=optimize)
+    print("Generated", output)
+
+    if cached:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write-then-rename so parallel workers never copy a partial entry
+            tmp = f"{cached}.{os.getpid()}.tmp"
+            shutil.copyfile(output, tmp)
+            os.replace(tmp, cached)
+        except OSError as e:
+            print("Cache error:", e)
+        if prune:
+            prune_cache(cache_dir, cache_size, protect=[cached])
+    return output
+
+def _generate_one(job):
+    card, optimize, cache_dir = job
+    card = dict(card)
+    output = card.pop("output")
+    return generate(output, card, optimize=optimize, cache_dir=cache_dir, prune=False)
+
+def check_cards(cards):
+    """Raise ValueError for a card render_many could not render, before any work starts."""
+    fields = inspect.signature(render_card).parameters
+    exts = Image.registered_extensions()
+    seen = set()
+    for i, card in enumerate(cards):
+        if not isinstance(card, dict):
+            raise ValueError(f"card {i}: expected an object, got {type(card).__name__}")
+        for k, v in card.items():
+            if k != "output" and k not in fields:
+                raise ValueError(f"card {i}: unknown field {k!r}")
+            want = bool if k == "draft" else str
+            if not isinstance(v, want):
+                raise ValueError(f"card {i}: {k!r} must be a {want.__name__}, got {v!r}")
+        output = card.get("output")
+        if not output:
+            raise ValueError(f"card {i}: missing \"output\"")
+        if os.path.splitext(output)[1].lower() not in exts:
+            raise ValueError(f"card {i}: unsupported output extension {output!r}")
+        path = os.path.normcase(os.path.abspath(output))
+        if path in seen:
+            raise ValueError(f"card {i}: duplicate output {output!r}")
+        seen.add(path)
+
+def render_many(cards, optimize=False, cache_dir=".og_cache", workers=None, cache_size=64):
+    """Generate several cards, sharing font/mask/canvas caches within each process.
+
+    Each card is a dict of render_card kwargs plus an "output" path. Cards are
+    spread over a process pool (os.cpu_count() workers by default); pass
+    workers=1 to render them sequentially in this process. The render cache
+    is pruned once at the end, keeping every entry this batch used.
+    """
+    check_cards(cards)
+    jobs = [(card, optimize, cache_dir) for card in cards]
+    if workers == 1 or len(jobs) < 2:
+        outputs = [_generate_one(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outputs = list(pool.map(_generate_one, jobs))
+    if cache_dir:
+        used = []
+        for card in cards:
+            card = dict(card)
+            output = card.pop("output")
+            used.append(cache_path(cache_dir, card, output, optimize))
+        prune_cache(cache_dir, cache_size, protect=used)
+    return outputs
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--output", default="social_preview.png")
+    ap.add_argument("--title", default="username/repo")
+    ap.add_argument("--subtitle", default="A project description.")
+    ap.add_argument("--author", default="")
+    ap.add_argument("--sha", default="")
+    ap.add_argument("--logo", default="assets/brand-logo.png")
+    ap.add_argument("--github-mark", default="assets/github-mark.png")
+    ap.add_argument("--draft", action="store_true", help="half-resolution layout preview, upscaled")
+    ap.add_argument("--optimize", action="store_true", help="smallest file (slower); use for published output")
+    ap.add_argument("--cache-dir", default=".og_cache", help="rendered card cache ('' to disable)")
+    ap.add_argument("--cache-size", type=int, default=64, help="max cached renders kept (entries used by this run are always kept)")
+    ap.add_argument("--manifest", help="JSON list of cards (render_card fields + output) to render in parallel")
+    ap.add_argument("--outdir", default=".", help="directory for relative outputs in --manifest")
+    ap.add_argument("--workers", type=int, default=None, help="batch worker processes (default: CPU count)")
+    args = ap.parse_args()
+
+    card = {k: getattr(args, k) for k in ("title", "subtitle", "author", "sha", "logo", "github_mark", "draft")}
+    if not args.manifest:
+        generate(args.output, card, optimize=args.optimize, cache_dir=args.cache_dir,
+                 cache_size=args.cache_size)
+        return
+
+    # Batch mode: CLI card options act as defaults for every manifest entry
+    with open(args.manifest) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        ap.error("manifest must be a JSON list of cards")
+    cards = []
+    try:
+        for i, entry in enumerate(entries):
+            if not isinstance(entry, dict) or not isinstance(entry.get("output"), str):
+                raise ValueError(f"card {i}: missing \"output\"")
+            c = dict(card, **entry)
+            c["output"] = os.path.join(args.outdir, entry["output"])
+            cards.append(c)
+        check_cards(cards)
+    except ValueError as e:
+        ap.error(f"{args.manifest}: {e}")
+    for c in cards:
+        os.makedirs(os.path.dirname(c["output"]) or ".", exist_ok=True)
+    render_many(cards, optimize=args.optimize, cache_dir=args.cache_dir, workers=args.workers,
+                cache_size=args.cache_size)
 
 if __name__ == "__main__":
     main()